@@ -1,20 +1,72 @@
 """Decoy generation workflow"""
 
 # Import relevant packages
-from CGRtools.files import RDFRead, RDFWrite
+from CGRtools.files import RDFRead
 from CGRtools.exceptions import *
-from ..util.utils import (generate_reactions, remove_reagents,
-                          containers_split, not_radical,
-                          get_rules)
-from ..util.routine import (_save_log, _util_file)
-from datetime import date
+from ..util.utils import (decoy_reactions, compile_rules)
+from ..util.routine import (_save_log, _util_file,
+                            _load_ids, _dump_ids,
+                            _dump_atomic, _file_digest,
+                            RDFupdate, RDFBuffer)
+from datetime import date, datetime
 
 import os
 import math
+import resource
 import multiprocessing
 import pickle
 import time
 import argparse
+import json
+
+
+def _save_block(block, reactors, max_decoys, limit, buffer, v, log, log_filename):
+    """
+    Decoys generation for a block of input reactions, logging and buffering of the results
+    """
+    for reaction, (decoys, status, strict) in zip(block, decoy_reactions(block, reactors, max_decoys, limit)):
+        if status == "Skipped":
+            continue
+        if not strict and log:
+            _save_log(log_filename,
+                      str("Failed to get strict templates for reaction with ID {}\n".format(
+                          reaction.meta["Reaction_ID"])))
+        if status == "Not recovered":
+            if v:
+                print("Reaction with ID {} was not recovered\n".format(reaction.meta["Reaction_ID"]))
+            if log:
+                _save_log(log_filename,
+                          str("Reaction with ID: {} was not recovered\n".format(reaction.meta["Reaction_ID"])))
+            continue
+
+        if v:
+            print("Reaction with ID {} was successfully recovered\n".format(reaction.meta["Reaction_ID"]))
+        if log:
+            _save_log(log_filename,
+                      str("Reaction with ID: {} was successfully recovered\n".format(reaction.meta["Reaction_ID"])))
+        buffer.extend(decoys)
+
+
+def _shard_suffix(shard):
+    return ".shard-{}-of-{}".format(*shard) if shard else ""
+
+
+_worker = None
+
+
+def _init_worker(config_fn="Config.pickle"):
+    """
+    Loading of the config, templates and processed Reaction_IDs, once per pool process
+    :param config_fn: config file name in the data/decoyGeneration directory
+    """
+    global _worker
+    path = "{}/data/decoyGeneration/".format(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+    with open("{}{}".format(path, config_fn), "rb") as configFile:
+        config_list = pickle.load(configFile)
+    templates_fn, index_fn = config_list[1], config_list[8]
+    with open(templates_fn, "rb") as pkl:
+        templates = pickle.load(pkl)
+    _worker = (config_list, _load_ids(index_fn) if index_fn else set(), compile_rules(templates))
 
 
 def main(n_proc):
@@ -32,73 +84,42 @@ def main(n_proc):
 
     Returns
     -------
-    :return: None
+    :return: Reaction_IDs examined by the worker
     """
     path = "{}/data/decoyGeneration/".format(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
-    with open("{}Config.pickle".format(path), "rb") as configFile:
-        config_list = pickle.load(configFile)
-        name_in, templates_fn, name_out, batch, max_decoys, limit, v, log = config_list
+    config_list, processed_ids, reactors = _worker
+    (name_in, templates_fn, name_out, batch, max_decoys, limit, v, log, index_fn,
+     template_major, block_size, mem_limit, shard, shard_start, shard_stop) = config_list
+    if not template_major:
+        block_size = 1  # reaction-major order: all templates are applied to each reaction in turn
 
-    with open(templates_fn, "rb") as pkl:
-        templates = pickle.load(pkl)
+    processed = []
 
     with RDFRead(name_in, indexable=True) as data:
 
         name = "Worker-{}".format(n_proc)
-        id_start = n_proc * batch
-        id_stop = id_start + batch
-        temp = []
+        id_start = shard_start + n_proc * batch
+        id_stop = min(id_start + batch, shard_stop)
+        buffer = RDFBuffer("{}/data/decoyGeneration/{}".format(os.path.join(os.getcwd(), os.pardir), name_out),
+                           mem_limit)
+        block = []
 
         # LOGGING
+        log_filename = None
         if log:
-            log_filename = "{}GENERATE_DECOYS_LOG.txt".format(path)
+            log_filename = "{}GENERATE_DECOYS_LOG{}.txt".format(path, _shard_suffix(shard))
         if log:
             _save_log(log_filename, str("Process {} initialized\n".format(name)))
         start_time = time.time()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
 
         for n, reaction in enumerate(data[id_start: id_stop], start=1):
-            doc = {}
-            reaction = remove_reagents(reaction)
-            if reaction is not None:
-                reaction = containers_split(reaction)
-                if len(reaction.reactants) == 2:
-                    cgr = reaction.compose()
-                    if not_radical(cgr):
-                        reaction.meta.update(INITIAL)
-                        doc.update({str(reaction.compose()): {"structure": reaction,
-                                                              "type": reaction.meta["type"]}})
-                        rules = get_rules(reaction)
-                        if rules:
-                            generate_reactions(reaction, reaction.reactants, rules,
-                                               max_decoys, limit, doc)
-                        else:
-                            if log:
-                                _save_log(log_filename,
-                                          str("Failed to get strict templates for reaction with ID {}\n".format(
-                                              reaction.meta["Reaction_ID"])))
-
-                        generate_reactions(reaction, reaction.reactants, templates,
-                                           max_decoys, limit, doc)
-                        if any([True if v["structure"].meta["type"].startswith("Initial") else False for v in
-                                doc.values()]):
-                            if v:
-                                print("Reaction with ID {} was not recovered\n".format(reaction.meta["Reaction_ID"]))
-                            if log:
-                                _save_log(log_filename,
-                                          str("Reaction with ID: {} was not recovered\n".format(
-                                              reaction.meta["Reaction_ID"])))
-                            continue
-
-                        if any([True if v["structure"].meta["type"].startswith("Reconstructed") else False for v in
-                                doc.values()]):
-                            if v:
-                                print("Reaction with ID {} was successfully recovered\n".format(
-                                        reaction.meta["Reaction_ID"]))
-                            if log:
-                                _save_log(log_filename,
-                                          str("Reaction with ID: {} was successfully recovered\n".format(
-                                              reaction.meta["Reaction_ID"])))
-                            temp.extend([x["structure"] for x in doc.values()])
+            if reaction.meta["Reaction_ID"] not in processed_ids:  # incremental mode: skip already examined
+                processed.append(reaction.meta["Reaction_ID"])
+                block.append(reaction)
+            if len(block) == block_size:
+                _save_block(block, reactors, max_decoys, limit, buffer, v, log, log_filename)
+                block = []
             if batch < 10000:
                 continue
             if n % (batch / 10) == 0 and n != batch:
@@ -108,24 +129,26 @@ def main(n_proc):
                 if log:
                     _save_log(log_filename,
                               str("Process {} stepped over: {} by {}s\n".format(name, n, iter_time - start_time)))
-                with open("{}/data/decoyGeneration/{}".format(os.path.join(os.getcwd(), os.pardir),
-                                                              name_out), "a") as w, RDFWrite(w) as rdf:
-                    for item in temp:
-                        rdf.write(item)
-                temp = []
+                buffer.flush()
         else:
+            if block:
+                _save_block(block, reactors, max_decoys, limit, buffer, v, log, log_filename)
+            buffer.close()
             end_time = time.time()
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            # ru_maxrss is the peak over the whole life of the pool process, which runs many batches
+            memory = "Process {} (pid {}) peak buffer: {:.1f}MB, process lifetime peak RSS: {:.1f}MB " \
+                     "(+{:.1f}MB during the batch)\n".format(name, os.getpid(), buffer.peak / 2 ** 20,
+                                                              peak_rss, peak_rss - start_rss)
             if v:
                 print("Process {} finished batch processing in time: {}s\n".format(name, end_time - start_time))
+                print(memory)
             if log:
                 _save_log(log_filename,
                           str("Process {} finished batch processing in time: {}s\n".format(name,
                                                                                            end_time - start_time)))
-            with open("{}/data/decoyGeneration/{}".format(os.path.join(os.getcwd(), os.pardir),
-                                                          name_out), "a") as w, RDFWrite(w) as rdf:
-                for item in temp:
-                    rdf.write(item)
-    return
+                _save_log(log_filename, memory)
+    return processed
 
 
 if __name__ == '__main__':
@@ -150,20 +173,67 @@ if __name__ == '__main__':
                         help='Number of templates to be used; defaults to 1000')
     parser.add_argument('--log', type=bool, default=True,
                         help='Whether to log wall times / errors check / etc., default True')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Path to the persistent index pickle file of the signatures in the store; enables '
+                             'the incremental mode, in which only reactions whose Reaction_ID is absent from '
+                             'the {index}.ids.pickle file are processed; defaults to None')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Path to the deduplicated store pickle file the new output is merged into; '
+                             'required with --index, except in the shard mode; defaults to None')
+    parser.add_argument('--template_major', action='store_true',
+                        help='Apply each template to a whole block of reactions before the next template '
+                             '(template-major order) instead of all templates to each reaction')
+    parser.add_argument('--block', type=int, default=100,
+                        help='Number of reactions per block in the template-major mode; defaults to 100')
+    parser.add_argument('--mem_limit', type=int, default=64,
+                        help='Size of the output buffer of each worker in MB, '
+                             'the buffer is appended to the output file once exceeded; defaults to 64. '
+                             'In the template-major mode up to --block reactions with up to --num generated '
+                             'structures each are held in addition to the buffer')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Process only the i-th of N equal slices of the input file, given as i/N with '
+                             '0 <= i < N; the output, its manifest and processed Reaction_IDs get '
+                             'a .shard-i-of-N suffix, see shardMerge.py; with --index only reactions absent '
+                             'from the index are processed; defaults to None')
     args = parser.parse_args()
     log = bool(args.log)
 
-    path = "{}/data/decoyGeneration/".format(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
+    if args.block < 1:
+        parser.error("--block must be at least 1")
+
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(x) for x in args.shard.split("/"))
+            if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+                raise ValueError
+        except ValueError:
+            parser.error("--shard must be given as i/N with 0 <= i < N")
+        if args.store:
+            parser.error("--store cannot be combined with --shard, pass it to shardMerge.py instead")
+    elif bool(args.index) != bool(args.store):
+        parser.error("--index and --store must be given together")
+        root, ext = os.path.splitext(args.name_out)
+        args.name_out = "{}{}{}".format(root, _shard_suffix(shard), ext)
+    config_fn = "Config{}.pickle".format(_shard_suffix(shard))
 
-    INITIAL = {"type": "Initial"}
-    RECONSTRUCTED = {"type": "Reconstructed"}
-    DECOY = {"type": "Decoy"}
+    path = "{}/data/decoyGeneration/".format(os.path.abspath(os.path.join(os.getcwd(), os.pardir)))
 
     _util_file(str("{}{}".format(path, args.name_out)))  # delete the rdf file if it was created earlier
+    if shard:
+        _util_file("{}{}.json".format(path, os.path.splitext(args.name_out)[0]))  # and the manifest of its shard
+        _util_file("{}{}.ids.pickle".format(path, os.path.splitext(args.name_out)[0]))
     if log:
-        _util_file("{}GENERATE_DECOYS_LOG.txt".format(path))
+        _util_file("{}GENERATE_DECOYS_LOG{}.txt".format(path, _shard_suffix(shard)))
+
+    with RDFRead(str(args.name_in), indexable=True) as file:
+        input_size = len(file)
+    if shard:
+        shard_start, shard_stop = input_size * shard[0] // shard[1], input_size * (shard[0] + 1) // shard[1]
+    else:
+        shard_start, shard_stop = 0, input_size
 
-    with open("{}Config.pickle".format(path), "wb") as config:
+    with open("{}{}".format(path, config_fn), "wb") as config:
         config_list = [
             str(args.name_in),
             str(args.template_pkl),
@@ -172,12 +242,54 @@ if __name__ == '__main__':
             int(args.num),
             int(args.lim),
             bool(args.v),
-            bool(args.log)
+            bool(args.log),
+            args.index,
+            bool(args.template_major),
+            int(args.block),
+            int(args.mem_limit) * 2 ** 20,
+            shard,
+            shard_start,
+            shard_stop
         ]
         pickle.dump(config_list, config)
 
-    with RDFRead(str(args.name_in), indexable=True) as file:
-        chunk = math.ceil(len(file) / 1000)
+    chunk = math.ceil((shard_stop - shard_start) / int(args.batch))
+
+    with multiprocessing.Pool(processes=int(args.num_proc), initializer=_init_worker,
+                              initargs=(config_fn,)) as pool:
+        processed = pool.map(main, list(range(chunk)))
+
+    if shard:
+        output_fn = "{}{}".format(path, args.name_out)
+        ids_fn = "{}.ids.pickle".format(os.path.splitext(output_fn)[0])
+        _dump_atomic(ids_fn, {x for batch_ids in processed for x in batch_ids})
+        manifest = {
+            "input": os.path.abspath(str(args.name_in)),
+            "input_size": input_size,
+            "input_bytes": os.path.getsize(str(args.name_in)),
+            "input_digest": _file_digest(str(args.name_in)),
+            "templates": os.path.abspath(str(args.template_pkl)),
+            "templates_digest": _file_digest(str(args.template_pkl)),
+            "max_decoys": int(args.num),
+            "limit": int(args.lim),
+            "shard": shard[0],
+            "num_shards": shard[1],
+            "start": shard_start,
+            "stop": shard_stop,
+            "processed": sum(len(ids) for ids in processed),
+            "ids": os.path.basename(ids_fn),
+            "output": os.path.basename(output_fn),
+            "output_size": os.path.getsize(output_fn) if os.path.exists(output_fn) else 0,
+            "finished": datetime.now().isoformat(timespec="seconds")
+        }
+        manifest_fn = "{}.json".format(os.path.splitext(output_fn)[0])
+        with open("{}.tmp".format(manifest_fn), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace("{}.tmp".format(manifest_fn), manifest_fn)  # the manifest exists only for finished shards
 
-    with multiprocessing.Pool(processes=int(args.num_proc)) as pool:
-        pool.map(main, list(range(chunk)))
+    if args.index and not shard:  # shards record their Reaction_IDs for shardMerge.py instead
+        if os.path.exists("{}{}".format(path, args.name_out)):
+            RDFupdate(str("{}{}".format(path, args.name_out)), args.store, args.index, log, bool(args.v))
+        ids = _load_ids(args.index)  # marked as processed only once their output is in the store
+        ids.update(x for batch_ids in processed for x in batch_ids)
+        _dump_ids(args.index, ids)
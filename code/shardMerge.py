@@ -0,0 +1,41 @@
+"""Merging of decoyWF shard outputs"""
+
+# Import relevant packages
+from ..util.routine import (RDFmerge, _util_file, _ids_fn)
+
+import os
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('manifests', type=str, nargs='+',
+                        help='Paths to the manifest json files of all shards')
+    parser.add_argument('-name_out', type=str, required=True,
+                        help='Output rdf file name for the reactions this merge added to the store or '
+                             'replaced in it (the whole store for a fresh merge)')
+    parser.add_argument('-v', type=bool, default=False,
+                        help='Verbose printing; defaults to False')
+    parser.add_argument('--log', type=bool, default=True,
+                        help='Whether to log duplicates / errors check / etc., default True')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Path to the persistent index pickle file to merge into (incremental mode), '
+                             'the Reaction_IDs processed by the shards are added to it; '
+                             'defaults to a fresh index next to the output')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Path to the deduplicated store pickle file to merge into (incremental mode); '
+                             'defaults to a fresh store next to the output')
+    args = parser.parse_args()
+    if bool(args.index) != bool(args.store):
+        parser.error("--index and --store must be given together")
+
+    root = os.path.splitext(args.name_out)[0]
+    index_fn = args.index or "{}.index.pickle".format(root)
+    store_fn = args.store or "{}.store.pickle".format(root)
+    if not args.index:
+        _util_file(index_fn)
+        _util_file(_ids_fn(index_fn))
+    if not args.store:
+        _util_file(store_fn)
+
+    RDFmerge(args.manifests, args.name_out, store_fn, index_fn, bool(args.log), bool(args.v))
@@ -0,0 +1,192 @@
+"""Tests of the RDFclean dump merging and of the incremental store"""
+from types import SimpleNamespace
+
+import json
+import os
+import sys
+import pytest
+
+pytest.importorskip("CGRtools")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "util"))
+import routine
+from routine import (BloomFilter, _seed_bloom, _merge_dump,
+                     _dump_pkl, _load_pkl, _dump_stream, _load_stream,
+                     _load_index, _dump_index, _load_ids, _dump_ids,
+                     _dump_atomic, RDFupdate, RDFmerge)
+
+
+class _Reaction(SimpleNamespace):
+    def compose(self):
+        return self.signature
+
+
+def _reaction(reaction_type, reaction_id, signature=None):
+    return _Reaction(meta={"type": reaction_type, "Reaction_ID": reaction_id}, signature=signature)
+
+
+class _RDFRead:
+    files = {}
+
+    def __init__(self, filename, indexable=False):
+        self.reactions = self.files[filename]
+
+    def __enter__(self):
+        return self.reactions
+
+    def __exit__(self, *args):
+        pass
+
+
+class _RDFWrite(_RDFRead):
+    def __init__(self, filename):
+        self.reactions = self.files[filename] = []
+
+    def __enter__(self):
+        return self
+
+    def write(self, reaction):
+        self.reactions.append(reaction)
+
+
+@pytest.fixture
+def rdf_files(monkeypatch):
+    files = {}
+    monkeypatch.setattr(_RDFRead, "files", files)
+    monkeypatch.setattr(routine, "RDFRead", _RDFRead)
+    monkeypatch.setattr(routine, "RDFWrite", _RDFWrite)
+    return files
+
+
+def _types(store_fn):
+    return [{x: y.meta["type"] for x, y in rxn_dict.items()} for rxn_dict in _load_stream(store_fn)]
+
+
+def test_resumed_merge_keeps_reconstructed_precedence(tmp_path):
+    dump_fn = str(tmp_path / "dump")
+    _dump_pkl(dump_fn, {"A": _reaction("Decoy", 1), "B": _reaction("Decoy", 1)}, 10)
+
+    bloom = BloomFilter(100)
+    _seed_bloom(bloom, dump_fn, 10)
+    _merge_dump(dump_fn, {"A": _reaction("Reconstructed", 2)}, 10, 20, bloom)
+
+    dumped = list(_load_pkl(dump_fn, 20))
+    signatures = [x for rxn_dict in dumped for x in rxn_dict]
+    assert sorted(signatures) == ["A", "B"]
+    assert dumped[-1]["A"].meta["type"] == "Reconstructed"
+    assert not os.path.exists("{}_10.pickle".format(dump_fn))
+
+
+def test_resumed_merge_drops_duplicate_decoy(tmp_path):
+    dump_fn = str(tmp_path / "dump")
+    _dump_pkl(dump_fn, {"A": _reaction("Reconstructed", 1)}, 10)
+
+    bloom = BloomFilter(100)
+    _seed_bloom(bloom, dump_fn, 10)
+    _merge_dump(dump_fn, {"A": _reaction("Decoy", 2), "C": _reaction("Decoy", 2)}, 10, 20, bloom)
+
+    dumped = list(_load_pkl(dump_fn, 20))
+    assert dumped == [{"A": dumped[0]["A"]}, {"C": dumped[1]["C"]}]
+    assert dumped[0]["A"].meta["type"] == "Reconstructed"
+
+
+def test_merge_without_dump(tmp_path):
+    dump_fn = str(tmp_path / "dump")
+
+    bloom = BloomFilter(100)
+    _seed_bloom(bloom, dump_fn, 0)
+    _merge_dump(dump_fn, {"A": _reaction("Decoy", 1)}, 0, 10, bloom)
+
+    assert [list(x) for x in _load_pkl(dump_fn, 10)] == [["A"]]
+    assert "A" in bloom
+
+
+def test_update_replaces_stored_decoy(tmp_path, rdf_files):
+    store_fn, index_fn = str(tmp_path / "store.pickle"), str(tmp_path / "index.pickle")
+    _dump_stream(store_fn, {"A": _reaction("Decoy", 1, "A"), "B": _reaction("Decoy", 1, "B")})
+    rdf_files["new.rdf"] = [_reaction("Reconstructed", 2, "A"), _reaction("Decoy", 2, "C")]
+
+    assert RDFupdate("new.rdf", store_fn, index_fn, False, False) == {"A", "C"}
+    assert _types(store_fn) == [{"B": "Decoy"}, {"A": "Reconstructed", "C": "Decoy"}]
+    assert _load_index(index_fn) == {"A": "Reconstructed", "B": "Decoy", "C": "Decoy"}
+
+
+def test_update_drops_duplicate_decoy(tmp_path, rdf_files):
+    store_fn, index_fn = str(tmp_path / "store.pickle"), str(tmp_path / "index.pickle")
+    rdf_files["first.rdf"] = [_reaction("Reconstructed", 1, "A")]
+    rdf_files["second.rdf"] = [_reaction("Decoy", 2, "A"), _reaction("Decoy", 2, "B"), _reaction("Decoy", 3, "B")]
+
+    RDFupdate("first.rdf", store_fn, index_fn, False, False)
+    assert RDFupdate("second.rdf", store_fn, index_fn, False, False) == {"B"}
+    assert _types(store_fn) == [{"A": "Reconstructed"}, {"B": "Decoy"}]
+    assert next(_load_stream(store_fn))["A"].meta["Reaction_ID"] == 1
+
+
+def test_index_is_built_from_store(tmp_path):
+    store_fn, index_fn = str(tmp_path / "store.pickle"), str(tmp_path / "index.pickle")
+    _dump_stream(store_fn, {"A": _reaction("Reconstructed", 1, "A")})
+    _dump_stream(store_fn, {"B": _reaction("Decoy", 2, "B")})
+
+    assert _load_index(index_fn) == {}
+    assert _load_index(index_fn, store_fn) == {"A": "Reconstructed", "B": "Decoy"}
+    _dump_index(index_fn, {"A": "Reconstructed"})
+    assert _load_index(index_fn, store_fn) == {"A": "Reconstructed"}
+
+
+def _shard(tmp_path, rdf_files, shard, num_shards, start, stop, reactions, input_size=10):
+    name = "out.shard-{}-of-{}".format(shard, num_shards)
+    output = tmp_path / "{}.rdf".format(name)
+    if reactions:
+        output.write_bytes(b"rxn" * len(reactions))
+        rdf_files[str(output)] = reactions
+    _dump_atomic(str(tmp_path / "{}.ids.pickle".format(name)), {x.meta["Reaction_ID"] for x in reactions})
+    manifest = {"input_size": input_size, "input_bytes": 100, "input_digest": "in", "templates_digest": "tpl",
+                "max_decoys": 50, "limit": 5, "shard": shard, "num_shards": num_shards, "start": start,
+                "stop": stop, "ids": "{}.ids.pickle".format(name), "output": output.name,
+                "output_size": output.stat().st_size if reactions else 0}
+    manifest_fn = tmp_path / "{}.json".format(name)
+    manifest_fn.write_text(json.dumps(manifest))
+    return str(manifest_fn)
+
+
+def test_merge_exports_only_added_and_replaced(tmp_path, rdf_files):
+    store_fn, index_fn = str(tmp_path / "store.pickle"), str(tmp_path / "index.pickle")
+    merged_fn = str(tmp_path / "merged.rdf")
+    _dump_ids(index_fn, {0})
+
+    for directory in "abc":
+        (tmp_path / directory).mkdir()
+    first = [_shard(tmp_path / "a", rdf_files, 0, 2, 0, 5, [_reaction("Decoy", 1, "A")]),
+             _shard(tmp_path / "b", rdf_files, 1, 2, 5, 10, [_reaction("Reconstructed", 2, "A"),
+                                                             _reaction("Decoy", 2, "B")])]
+    RDFmerge(first, merged_fn, store_fn, index_fn, False, False)
+    assert sorted(x.signature for x in rdf_files[merged_fn]) == ["A", "B"]
+    assert _load_ids(index_fn) == {0, 1, 2}
+
+    second = [_shard(tmp_path / "c", rdf_files, 0, 1, 0, 10, [_reaction("Decoy", 3, "B"),
+                                                              _reaction("Decoy", 3, "C")])]
+    RDFmerge(second, merged_fn, store_fn, index_fn, False, False)
+    assert [x.signature for x in rdf_files[merged_fn]] == ["C"]
+    assert _load_ids(index_fn) == {0, 1, 2, 3}
+    assert _load_index(index_fn) == {"A": "Reconstructed", "B": "Decoy", "C": "Decoy"}
+
+
+@pytest.mark.parametrize("case, message", [("missing", "Missing or repeated"),
+                                           ("repeated", "Missing or repeated"),
+                                           ("gap", "does not start"),
+                                           ("truncated", "incomplete")])
+def test_merge_rejects_inconsistent_shards(tmp_path, rdf_files, case, message):
+    for directory in "abc":
+        (tmp_path / directory).mkdir()
+    reactions = [_reaction("Decoy", 1, "A")]
+    manifests = [_shard(tmp_path / "a", rdf_files, 0, 2, 0, 5, reactions)]
+    if case == "repeated":
+        manifests.append(_shard(tmp_path / "b", rdf_files, 0, 2, 0, 5, reactions))
+    if case != "missing":
+        manifests.append(_shard(tmp_path / "c", rdf_files, 1, 2, 6 if case == "gap" else 5, 10, reactions))
+    if case == "truncated":
+        (tmp_path / "c" / "out.shard-1-of-2.rdf").write_bytes(b"rx")
+
+    with pytest.raises(ValueError, match=message):
+        RDFmerge(manifests, str(tmp_path / "merged.rdf"), str(tmp_path / "store.pickle"),
+                 str(tmp_path / "index.pickle"), False, False)
+    assert not os.path.exists(str(tmp_path / "store.pickle"))
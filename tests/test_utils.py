@@ -0,0 +1,88 @@
+"""Tests of the generation routines"""
+import os
+import sys
+import pytest
+
+pytest.importorskip("CGRtools")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "util"))
+import utils
+from utils import (apply_rules, apply_rules_block, compile_rules,
+                   decoy_reactions, generate_decoys)
+
+
+class _Reactor:
+    def __init__(self, rule, **kwargs):
+        self.rule = rule
+
+    def __call__(self, reactants):
+        return self.rule(reactants)
+
+
+def _rule(products, fail_at=None):
+    def rule(reactants):
+        for n, product in enumerate(products):
+            if n == fail_at:
+                raise KeyError(product)
+            yield reactants, product
+    return rule
+
+
+@pytest.fixture
+def rules(monkeypatch):
+    monkeypatch.setattr(utils, "Reactor", _Reactor)
+    return [_rule([1, 2, 2, 3]), _rule([1, 4]), _rule([5, 6, 7], fail_at=2),
+            _rule([8, 9, 10, 11, 12]), _rule(range(20, 40))]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5])
+@pytest.mark.parametrize("max_decoys", [0, 3, 50])
+def test_block_of_one_matches_apply_rules(rules, limit, max_decoys):
+    expected = apply_rules("R", rules, limit, max_decoys)
+    assert apply_rules_block(["R"], compile_rules(rules), limit, max_decoys) == [expected]
+
+
+def test_block_keeps_reactions_apart(rules):
+    block = apply_rules_block(["R", "S"], compile_rules(rules), 2, 3)
+    assert block == [apply_rules("R", rules, 2, 3), apply_rules("S", rules, 2, 3)]
+
+
+class _Input:
+    def __init__(self, value):
+        self.value = value
+
+    def copy(self):
+        return _Input(self.value)
+
+
+def _decoy_reaction(reaction, reactors, max_decoys, limit):
+    if reaction.value == 3:
+        raise ValueError(reaction.value)
+    return [reaction.value * 10], "Recovered"
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_generate_decoys_order_and_read_ahead(monkeypatch, n_proc):
+    monkeypatch.setattr(utils, "compile_rules", lambda rules: None)
+    monkeypatch.setattr(utils, "decoy_reaction", _decoy_reaction)
+    consumed = []
+
+    def source():
+        for value in range(10):
+            consumed.append(value)
+            yield _Input(value)
+
+    results = []
+    for n, (reaction, decoys, status) in enumerate(generate_decoys(source(), [], n_proc=n_proc, max_in_flight=3)):
+        assert len(consumed) <= n + (3 if n_proc > 1 else 1)
+        results.append((reaction.value, decoys, status))
+
+    assert results == [(x, [], "Error") if x == 3 else (x, [x * 10], "Recovered") for x in range(10)]
+
+
+def test_skipped_results_are_independent(monkeypatch):
+    monkeypatch.setattr(utils, "prepare_reaction", lambda reaction: None)
+    results = decoy_reactions(["R", "S"], [], 5, 2)
+
+    assert results == [([], "Skipped", False), ([], "Skipped", False)]
+    results[0][0].append("decoy")
+    assert results[1][0] == []
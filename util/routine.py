@@ -1,13 +1,17 @@
 """Routine functions"""
 from CGRtools.files import (RDFRead, RDFWrite)
+from io import StringIO
 from tqdm import tqdm
 
+import hashlib
+import json
 import pickle
+import math
 import os
 
 
-def _load_pkl(filename, n):
-    with open("{}_{}.pickle".format(filename, n), "rb") as f:
+def _load_stream(filename):
+    with open(filename, "rb") as f:
         for i in range(2 ** 64):
             try:
                 yield pickle.load(f)
@@ -15,12 +19,144 @@ def _load_pkl(filename, n):
                 break
 
 
-def _dump_pkl(filename, to_save, n):
-    with open("{}_{}.pickle".format(filename, n), "ab") as f:
+def _dump_stream(filename, to_save):
+    with open(filename, "ab") as f:
         pickle.dump(to_save, f)
     return
 
 
+def _load_pkl(filename, n):
+    yield from _load_stream("{}_{}.pickle".format(filename, n))
+
+
+def _dump_pkl(filename, to_save, n):
+    _dump_stream("{}_{}.pickle".format(filename, n), to_save)
+    return
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings: a miss is always exact,
+    a hit is false with a probability of about fp_rate while at most capacity items are added
+    """
+    def __init__(self, capacity, fp_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(fp_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.num_hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RDFBuffer:
+    """
+    Output buffer keeping reactions as RDF text and appending it to the file once mem_limit bytes are exceeded
+    """
+    def __init__(self, filename, mem_limit):
+        self.filename = filename
+        self.mem_limit = mem_limit
+        self.peak = 0
+        self._buffer = StringIO()
+        self._rdf = RDFWrite(self._buffer)
+
+    def write(self, reaction):
+        self._rdf.write(reaction)
+        size = self._buffer.tell()
+        self.peak = max(self.peak, size)
+        if size > self.mem_limit:
+            self.flush()
+
+    def extend(self, reactions):
+        for reaction in reactions:
+            self.write(reaction)
+
+    def flush(self):
+        if self._buffer.tell():
+            with open(self.filename, "a") as w:
+                w.write(self._buffer.getvalue())
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+    def close(self):
+        self.flush()
+        self._rdf.close()
+
+
+def _load_atomic(filename, default):
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _file_digest(filename):
+    digest = hashlib.blake2b()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _dump_atomic(filename, obj):
+    with open("{}.tmp".format(filename), "wb") as f:
+        pickle.dump(obj, f)
+    os.replace("{}.tmp".format(filename), filename)
+
+
+def _ids_fn(index_fn):
+    return "{}.ids.pickle".format(os.path.splitext(index_fn)[0])
+
+
+def _load_ids(index_fn):
+    """
+    Processed Reaction_IDs of the incremental mode, kept apart from the index so that workers load only them
+    :param index_fn: index pickle file
+    :return: set of Reaction_IDs
+    """
+    return _load_atomic(_ids_fn(index_fn), set())
+
+
+def _dump_ids(index_fn, ids):
+    _dump_atomic(_ids_fn(index_fn), ids)
+
+
+def _load_index(index_fn, store_fn=None):
+    """
+    Signatures index of the incremental mode.
+    If the index does not exist yet, it is built from the store (or from an RDFclean dump of the same format)
+    :param index_fn: index pickle file
+    :param store_fn: store pickle file
+    :return: dict{CGR signature: reaction type}
+    """
+    signatures = _load_atomic(index_fn, None)
+    if signatures is None:
+        signatures = dict()
+        if store_fn and os.path.exists(store_fn):
+            for rxn_dict in _load_stream(store_fn):
+                signatures.update({signature: reaction.meta["type"] for signature, reaction in rxn_dict.items()})
+    return signatures
+
+
+def _dump_index(index_fn, signatures):
+    _dump_atomic(index_fn, signatures)
+
+
 def _db_check(cgr):
     if len(cgr.center_bonds) > 1 and len(cgr.center_bonds) != 0:
         return True
@@ -55,7 +191,48 @@ def _save_log(filename, string):
         flog.write(string)
 
 
-def RDFclean(RDFfilename, log, dump_size, dump_fn, v):
+def _seed_bloom(bloom, dump_fn, num):
+    """
+    Adding the signatures of the dump RDFclean resumes from to the prefilter
+    :param bloom: BloomFilter
+    """
+    try:
+        for rxn_dict in _load_pkl(dump_fn, num):
+            bloom.update(rxn_dict)
+    except FileNotFoundError:
+        pass
+
+
+def _merge_dump(dump_fn, to_save, num, n, bloom):
+    """
+    Resolving duplicates between to_save and the dumped dicts, and moving the dump from num to n
+    :param bloom: BloomFilter of the already dumped signatures
+    """
+    candidates = {x for x in to_save if x in bloom}  # the dump is read only if a duplicate is possible
+    try:
+        if candidates:
+            for rxn_dict in _load_pkl(dump_fn, num):
+                for duplicate in candidates.intersection(rxn_dict).intersection(to_save):
+                    try:
+                        if to_save[duplicate].meta["type"].startswith("Reconstructed"):
+                            del rxn_dict[duplicate]
+                        elif to_save[duplicate].meta["type"].startswith("Decoy"):
+                            del to_save[duplicate]
+                    except KeyError:
+                        del to_save[duplicate]
+                        continue
+                _dump_pkl(dump_fn, rxn_dict, n)
+        else:
+            os.replace("{}_{}.pickle".format(dump_fn, num), "{}_{}.pickle".format(dump_fn, n))
+    except (FileNotFoundError, UnboundLocalError):
+        pass
+    _dump_pkl(dump_fn, to_save, n)
+    if num != n:
+        _util_file("{}_{}.pickle".format(dump_fn, num))
+    bloom.update(to_save)
+
+
+def RDFclean(RDFfilename, log, dump_size, dump_fn, v, fp_rate=0.01):
     """
     Dump pickling and removing duplicates
     :param RDFfilename: RDF file to check duplicates and examine
@@ -63,13 +240,16 @@ def RDFclean(RDFfilename, log, dump_size, dump_fn, v):
     :param dump_size: size of dict to dump
     :param dump_fn: outer file name
     :param v: printing if necessary
+    :param fp_rate: false positive rate of the signature prefilter
     """
     with RDFRead(RDFfilename, indexable=True) as file:
 
         to_save = dict()
+        bloom = BloomFilter(len(file), fp_rate)
         log_filename = "CLEANING_LOG.txt"
         flag = True
         flag_pass = True
+        seeded = False
 
         for n, reaction in enumerate(tqdm(file), start=1):
             if n != 2210001 and flag_pass:
@@ -79,6 +259,9 @@ def RDFclean(RDFfilename, log, dump_size, dump_fn, v):
             if flag:
                 num = n - 1
                 flag = False
+                if not seeded:
+                    _seed_bloom(bloom, dump_fn, num)
+                    seeded = True
             try:
                 if str(reaction.compose()) not in to_save:
                     to_save.update({str(reaction.compose()): reaction})
@@ -107,40 +290,137 @@ def RDFclean(RDFfilename, log, dump_size, dump_fn, v):
                 continue
             if n % dump_size == 0:
                 flag = True
-                try:
-                    for rxn_dict in _load_pkl(dump_fn, num):
-                        for duplicate in set(to_save).intersection(set(rxn_dict)):
-                            try:
-                                if to_save[duplicate].meta["type"].startswith("Reconstructed"):
-                                    del rxn_dict[duplicate]
-                                elif to_save[duplicate].meta["type"].startswith("Decoy"):
-                                    del to_save[duplicate]
-                            except KeyError:
-                                del to_save[duplicate]
-                                continue
-                        _dump_pkl(dump_fn, rxn_dict, n)
-                    else:
-                        _dump_pkl(dump_fn, to_save, n)
-                        to_save = dict()
-                        _util_file("{}_{}.pickle".format(dump_fn, num))
-                except (FileNotFoundError, UnboundLocalError):
-                    _dump_pkl(dump_fn, to_save, n)
-                    to_save = dict()
+                _merge_dump(dump_fn, to_save, num, n, bloom)
+                to_save = dict()
         else:
-            for rxn_dict in _load_pkl(dump_fn, num):
-                for duplicate in set(to_save).intersection(set(rxn_dict)):
-                    try:
-                        if to_save[duplicate].meta["type"].startswith("Reconstructed"):
-                            del rxn_dict[duplicate]
-                        elif to_save[duplicate].meta["type"].startswith("Decoy"):
-                            del to_save[duplicate]
-                    except KeyError:
-                        del to_save[duplicate]
-                        continue
-                _dump_pkl(dump_fn, rxn_dict, n)
-            else:
-                _dump_pkl(dump_fn, to_save, n)
-                _util_file("{}_{}.pickle".format(dump_fn, num))
+            _merge_dump(dump_fn, to_save, num, n, bloom)
+
+
+def RDFupdate(RDFfilename, store_fn, index_fn, log, v):
+    """
+    Incremental merging of newly generated reactions into the deduplicated store.
+    Reconstructed reactions take precedence over decoys, as in RDFclean
+    :param RDFfilename: RDF file with newly generated reactions
+    :param store_fn: store pickle file (stream of dicts {CGR signature: ReactionContainer}, as RDFclean dumps)
+    :param index_fn: index pickle file (see _load_index), built from the store if missing
+    :param log: log if necessary
+    :param v: printing if necessary
+    :return: set of new or replaced signatures
+    """
+    signatures = _load_index(index_fn, store_fn)
+    log_filename = "CLEANING_LOG.txt"
+    to_save = dict()
+    replaced = set()
+
+    with RDFRead(RDFfilename, indexable=True) as file:
+        for n, reaction in enumerate(tqdm(file), start=1):
+            try:
+                signature = str(reaction.compose())
+                if signature in to_save:
+                    old_type = to_save[signature].meta["type"]
+                else:
+                    old_type = signatures.get(signature)
+                if old_type is None:
+                    to_save.update({signature: reaction})
+                elif reaction.meta["type"].startswith("Reconstructed") and not old_type.startswith("Reconstructed"):
+                    if v: print("Replaced by reconstructed: {}".format(reaction.meta["Reaction_ID"]))
+                    if log: _save_log(log_filename,
+                                      str("Replaced by reconstructed: {}\n".format(reaction.meta["Reaction_ID"])))
+                    if signature in signatures:
+                        replaced.add(signature)
+                    to_save.update({signature: reaction})
+                else:
+                    duplicate = "reconstructed" if reaction.meta["type"].startswith("Reconstructed") else "decoy"
+                    if v: print("Founded duplicate {}: {}".format(duplicate, reaction.meta["Reaction_ID"]))
+                    if log: _save_log(log_filename, str("Founded duplicate {}: {}\n".format(
+                        duplicate, reaction.meta["Reaction_ID"])))
+            except Exception as e:
+                if v: print("{} was occurred, number: {}, rxn_ID: {}\n".format(e, n, reaction.meta["Reaction_ID"]))
+                if log: _save_log(log_filename, str("{} was occurred, number: {}, rxn_ID: {}\n".format(
+                    e, n, reaction.meta["Reaction_ID"])))
+                continue
+
+    if replaced:  # the store is rewritten only when stored decoys were superseded
+        tmp_fn = "{}.tmp".format(store_fn)
+        _util_file(tmp_fn)
+        for rxn_dict in _load_stream(store_fn):
+            for signature in replaced.intersection(rxn_dict):
+                del rxn_dict[signature]
+            if rxn_dict:
+                _dump_stream(tmp_fn, rxn_dict)
+        if os.path.exists(tmp_fn):
+            os.replace(tmp_fn, store_fn)
+        else:  # every stored reaction was replaced
+            _util_file(store_fn)
+    if to_save:
+        _dump_stream(store_fn, to_save)
+        signatures.update({signature: reaction.meta["type"] for signature, reaction in to_save.items()})
+    _dump_index(index_fn, signatures)
+    return set(to_save)
+
+
+def RDFmerge(manifest_fns, RDFfilename, store_fn, index_fn, log, v):
+    """
+    Merging of the decoyWF shard outputs into one deduplicated RDF file (see RDFupdate).
+    Reaction_IDs processed by the shards are added to the processed ones of the index
+    :param manifest_fns: manifest files of all shards
+    :param RDFfilename: RDF file for the reactions this merge added to the store or replaced in it
+    :param store_fn: store pickle file
+    :param index_fn: index pickle file
+    :param log: log if necessary
+    :param v: printing if necessary
+    """
+    manifests = []
+    for manifest_fn in manifest_fns:
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+        manifest["output"] = os.path.join(os.path.dirname(os.path.abspath(manifest_fn)), manifest["output"])
+        manifest["ids"] = os.path.join(os.path.dirname(os.path.abspath(manifest_fn)), manifest["ids"])
+        manifests.append(manifest)
+    if not manifests:
+        raise ValueError("No shard manifests given")
+    manifests.sort(key=lambda x: x["shard"])
+
+    for key in ("input_size", "input_bytes", "input_digest", "templates_digest", "max_decoys", "limit",
+                "num_shards"):
+        if any(x[key] != manifests[0][key] for x in manifests):
+            raise ValueError("Shards were generated with different {}".format(key))
+    num_shards = manifests[0]["num_shards"]
+    shards = [x["shard"] for x in manifests]
+    if shards != list(range(num_shards)):
+        raise ValueError("Missing or repeated shards: expected 0..{}, got {}".format(num_shards - 1, shards))
+    stop = 0
+    for manifest in manifests:
+        if manifest["start"] != stop:
+            raise ValueError("Shard {} does not start where the previous one stops".format(manifest["shard"]))
+        stop = manifest["stop"]
+        size = os.path.getsize(manifest["output"]) if os.path.exists(manifest["output"]) else 0
+        if size != manifest["output_size"]:
+            raise ValueError("Output of shard {} is incomplete: {}".format(manifest["shard"], manifest["output"]))
+        if not os.path.exists(manifest["ids"]):
+            raise ValueError("Reaction_IDs of shard {} are missing: {}".format(manifest["shard"], manifest["ids"]))
+    if stop != manifests[0]["input_size"]:
+        raise ValueError("Shards do not cover the whole input")
+
+    merged = set()
+    for manifest in manifests:
+        if manifest["output_size"]:
+            signatures = RDFupdate(manifest["output"], store_fn, index_fn, log, v)
+            merged.update(signatures)
+            if v: print("Shard {} merged, new reactions: {}".format(manifest["shard"], len(signatures)))
+    ids = _load_ids(index_fn)
+    for manifest in manifests:
+        ids.update(_load_atomic(manifest["ids"], set()))
+    _dump_ids(index_fn, ids)
+
+    _util_file(RDFfilename)
+    with RDFWrite(RDFfilename) as rdf:
+        if os.path.exists(store_fn):
+            for rxn_dict in _load_stream(store_fn):
+                for signature, reaction in rxn_dict.items():
+                    if signature in merged:
+                        rdf.write(reaction)
+
 
 def Compile(input_file, output_file):
     with open(input_file, "rb") as file, \
@@ -4,6 +4,9 @@ from CGRtools.reactor import Reactor
 from CGRtools.containers import ReactionContainer
 from CGRtools.exceptions import (InvalidAromaticRing,
                                  MappingError)
+from collections import deque
+
+import multiprocessing
 
 INITIAL = {"type": "Initial"}
 RECONSTRUCTED = {"type": "Reconstructed"}
@@ -62,6 +65,115 @@ def containers_split(reaction):
                              meta=reaction.meta)
 
 
+def prepare_reaction(reaction):
+    """
+    Preprocessing of the input reaction before decoys generation
+    :param reaction: input reaction
+    :return: ReactionContainer marked as Initial or None if the reaction is not suitable
+    """
+    reaction = remove_reagents(reaction)
+    if reaction is None:
+        return None
+    reaction = containers_split(reaction)
+    if len(reaction.reactants) != 2 or not not_radical(reaction.compose()):
+        return None
+    reaction.meta.update(INITIAL)
+    return reaction
+
+
+def decoy_reactions(reactions, reactors, max_decoys, limit):
+    """
+    Decoys generation for a block of reactions: strict rules of each reaction first,
+    then the compiled templates applied to the whole block in the template-major order
+    :param reactions: list of input reactions
+    :param reactors: compiled templates (see compile_rules)
+    :param max_decoys: max number of reaction to generate
+    :param limit: max number of reaction from one transformation
+    :return: list[(list[ReactionContainer, ...], status, strict), ...] for each input reaction,
+    status is one of "Skipped", "Not recovered", "Recovered", strict is whether the strict rules were obtained
+    """
+    results = [([], "Skipped", False) for _ in reactions]
+    block = []
+    for i, reaction in enumerate(reactions):
+        reaction = prepare_reaction(reaction)
+        if reaction is None:
+            continue
+        doc = {str(reaction.compose()): {"structure": reaction,
+                                         "type": reaction.meta["type"]}}
+        rules = get_rules(reaction)
+        if rules:
+            generate_reactions(reaction, reaction.reactants, rules, max_decoys, limit, doc)
+        block.append((i, reaction, doc, bool(rules)))
+
+    generate_reactions_block([(reaction, doc) for _, reaction, doc, _ in block], reactors, max_decoys, limit)
+    for i, reaction, doc, strict in block:
+        if any(x["type"].startswith("Initial") for x in doc.values()):
+            results[i] = ([], "Not recovered", strict)
+        else:
+            results[i] = ([x["structure"] for x in doc.values()], "Recovered", strict)
+    return results
+
+
+def decoy_reaction(reaction, reactors, max_decoys, limit):
+    """
+    Decoys generation for a single reaction (see decoy_reactions)
+    :return: (list[ReactionContainer, ...], status)
+    """
+    decoys, status, _ = decoy_reactions([reaction], reactors, max_decoys, limit)[0]
+    return decoys, status
+
+
+_worker_config = None
+
+
+def _init_worker(templates, max_decoys, limit):
+    global _worker_config
+    _worker_config = (compile_rules(templates), max_decoys, limit)
+
+
+def _decoy_worker(reaction):
+    try:
+        return decoy_reaction(reaction, *_worker_config)
+    except Exception:
+        return [], "Error"
+
+
+def generate_decoys(reactions, templates, n_proc=1, max_decoys=50, limit=5, max_in_flight=None):
+    """
+    Lazy decoys generation in a process pool, results are yielded in the input order
+    :param reactions: iterable of input reactions, consumed no further than max_in_flight ahead
+    :param templates: list of templates (list[ReactionContainer, ...])
+    :param n_proc: num pool worker, the generation runs in the current process if n_proc < 2
+    :param max_decoys: max number of reaction to generate
+    :param limit: max number of reaction from one transformation
+    :param max_in_flight: max number of submitted and not yielded reactions; defaults to 2 * n_proc
+    :return: yield(input reaction, list[ReactionContainer, ...], status), see decoy_reaction;
+    a failed reaction gets the "Error" status and does not stop the generation
+    """
+    if n_proc < 2:
+        reactors = compile_rules(templates)
+        for reaction in reactions:
+            try:
+                decoys, status = decoy_reaction(reaction.copy(), reactors, max_decoys, limit)
+            except Exception:
+                decoys, status = [], "Error"
+            yield reaction, decoys, status
+        return
+
+    max_in_flight = max_in_flight or 2 * n_proc
+    with multiprocessing.Pool(processes=n_proc, initializer=_init_worker,
+                              initargs=(templates, max_decoys, limit)) as pool:
+        in_flight = deque()
+        for reaction in reactions:
+            in_flight.append((reaction, pool.apply_async(_decoy_worker, (reaction,))))
+            if len(in_flight) >= max_in_flight:
+                reaction, result = in_flight.popleft()
+                yield (reaction, *result.get())
+        while in_flight:
+            reaction, result = in_flight.popleft()
+            yield (reaction, *result.get())
+
+
 def generate_reactions(reaction, reactants, rules, max_decoys, limit, doc):
     """
     Accumulation of generated reactions
@@ -72,8 +184,25 @@ def generate_reactions(reaction, reactants, rules, max_decoys, limit, doc):
     :param limit: max number of reaction from one transformation
     :param doc: Dict[CGR(reaction), Dict[ReactionContainer, reaction type]}]
     """
+    _collect_reactions(reaction, reactants, apply_rules(reactants, rules, limit, max_decoys), max_decoys, doc)
+
+
+def generate_reactions_block(block, reactors, max_decoys, limit):
+    """
+    Accumulation of generated reactions in the template-major order
+    :param block: list[(input reaction, doc), ...]
+    :param reactors: compiled rules (see compile_rules)
+    :param max_decoys: max number of reaction to generate
+    :param limit: max number of reaction from one transformation
+    """
+    reactants_block = [reaction.reactants for reaction, _ in block]
+    for (reaction, doc), rxn_list in zip(block, apply_rules_block(reactants_block, reactors, limit, max_decoys)):
+        _collect_reactions(reaction, reaction.reactants, rxn_list, max_decoys, doc)
+
+
+def _collect_reactions(reaction, reactants, generated, max_decoys, doc):
     rxn_list = []
-    for n, r in enumerate(apply_rules(reactants, rules, limit, max_decoys)):
+    for n, r in enumerate(generated):
         if len(rxn_list) == max_decoys:
             break
         new_reaction = ReactionContainer(reactants=reactants,
@@ -120,10 +249,7 @@ def apply_rules(reactants, rules, limit, max_decoys):
     :param max_decoys: max number of reaction to generate
     :return: yield(ReactionContainer) of generated reaction
     """
-    reactors = [Reactor(rule,
-                        delete_atoms=True,
-                        one_shot=True,
-                        automorphism_filter=False) for rule in rules]  # NB! CGRtools v. > 4.1.22
+    reactors = compile_rules(rules)
     rxn_list = []
     queue = [r(reactants) for r in reactors]
 
@@ -149,6 +275,49 @@ def apply_rules(reactants, rules, limit, max_decoys):
     return rxn_list
 
 
+def apply_rules_block(reactants_block, reactors, limit, max_decoys):
+    """
+    Template-major variant of apply_rules: each rule is applied to the whole block before the next one
+    :param reactants_block: list of reactants of input reactions
+    :param reactors: compiled rules (see compile_rules)
+    :param limit: max number of reaction from one transformation
+    :param max_decoys: max number of reaction to generate
+    :return: list[list[ReactionContainer, ...], ...] of generated reactions for each input reaction
+    """
+    rxn_lists = [[] for _ in reactants_block]
+
+    for reactor in reactors:
+        for reactants, rxn_list in zip(reactants_block, rxn_lists):
+            if len(rxn_list) >= max_decoys + 10:
+                continue
+            try:
+                rxn_from_apply = []
+                for new_reaction in reactor(reactants):
+                    if new_reaction in rxn_from_apply or \
+                            new_reaction in rxn_list:
+                        continue
+
+                    rxn_from_apply.append(new_reaction)
+                    if len(rxn_from_apply) == limit:
+                        break
+                rxn_list.extend(rxn_from_apply)
+            except KeyError:
+                continue
+    return rxn_lists
+
+
+def compile_rules(rules):
+    """
+    Rules compilation
+    :param rules: list of rules (list[ReactionContainer, ...])
+    :return: list[Reactor, ...]
+    """
+    return [Reactor(rule,
+                    delete_atoms=True,
+                    one_shot=True,
+                    automorphism_filter=False) for rule in rules]  # NB! CGRtools v. > 4.1.22
+
+
 def get_rules(reaction):
     """
     Obtaining the rules of reaction transformations